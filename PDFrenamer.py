@@ -1,94 +1,343 @@
 import streamlit as st
-import re
-import pdfplumber
+import hashlib
+import gc
 from io import BytesIO
 import zipfile
 import os
-from typing import Optional, Tuple
+from contextlib import closing
+from typing import Iterator, Optional, Tuple
+
+try:
+    # Third-party regex: drop-in for the re API used here, and about 3x
+    # faster on these patterns (both the text scans and the raw-bytes scan)
+    import regex as re
+except ImportError:
+    import re
+
+try:
+    # google-re2: linear-time matching, same API for everything used here
+    import re2 as _re_fast
+except ImportError:
+    _re_fast = re
+
+# pypdf's plain text extraction skips the layout analysis pdfplumber does,
+# which is all the regex matching below needs. Flip this to go back to
+# pdfplumber if a supplier's layout ever confuses pypdf.
+USE_PDFPLUMBER = False
+
+# IDs sit near the top of the first page, so only this much text is
+# scanned first; the full text is only searched on a miss.
+ID_SCAN_WINDOW = 8192
+
+# Tail of the previous page kept in front of the next one, so an ID or
+# supplier name split across a page break is still matched.
+PAGE_OVERLAP = 256
 
 # -------------------------------
-# Extraction helpers
+# Compiled patterns
 # -------------------------------
 
-def _normalise_text(text: str) -> str:
-    return re.sub(r"[ \t]+", " ", re.sub(r"\r?\n+", "\n", text)).strip()
+_UNSAFE_TABLE = str.maketrans({c: "_" for c in '\\/:*?"<>|'})
+# re2's \s is ASCII-only ([\t\n\f\r ]), while re's also takes the no-break
+# spaces pypdf often emits. Every other whitespace character is mapped to a
+# plain space once per text, so all engines match the same.
+_SPACE_TABLE = str.maketrans({
+    c: " " for c in range(0x3001) if chr(c).isspace() and chr(c) not in " \t\n\r\f"
+})
+_RE_DASH = re.compile(r"\s*[-–]\s*")
+
+def _compile_ci(pattern: str):
+    # re2 takes no flags argument, so case-insensitivity goes inline
+    return _re_fast.compile("(?i)" + pattern)
+
+# Hyphenated pairs: an invoice-AGR pair anywhere beats an AGR-invoice pair,
+# and either beats every bare match (see _find_pair).
+_RE_PAIR_INV_AGR = _compile_ci(r"\b((?:IV|IN|CN)\d{5,})\s*[-–]\s*(AGR\d{4,})\b")
+_RE_PAIR_AGR_INV = _compile_ci(r"\b(AGR\d{4,})\s*[-–]\s*((?:IV|IN|CN)\d{5,})\b")
+
+# Bare invoice / AGR numbers, scanned in a single pass. Dispatch on
+# m.lastgroup (see _scan_ids).
+_RE_IDS = _compile_ci(
+    r"(?P<inv>\b(?:IV|IN|CN)\d{5,}\b)"
+    r"|(?P<agr>\bAGR\d{4,}\b)"
+)
+_RE_INV = _compile_ci(r"(?P<inv>\b(?:IV|IN|CN)\d{5,}\b)")
+_RE_AGR = _compile_ci(r"\bAGR\d{4,}\b")
+
+# Per-supplier layouts: SSE uses IV invoices (CN for credit notes) alongside
+# AGR site refs.
+# Corona (CN, then IN, then a labelled IV/CN number) uses the ordered
+# _CORONA_INV_PATTERNS below.
+_RE_SSE_IDS = _compile_ci(
+    r"(?P<inv>\b(?:IV|CN)\d{5,}\b)"
+    r"|(?P<agr>\bAGR\d{4,}\b)"
+)
+_RE_CORONA = _compile_ci(r"\bcorona\s+energy\b")
+_RE_SSE_WORD = _compile_ci(r"\bSSE\b")
+
+# Raw-bytes pre-scan. Only uncompressed page content streams are read: the
+# stream dictionary may hold nothing but /Length, which rules out filtered
+# streams, XMP metadata, form XObjects (annotation appearances) and font
+# programs, and nothing outside a stream (/Info, outlines) is looked at.
+_RE_BYTES_CONTENT = re.compile(
+    rb"<<\s*/Length\s+\d+(?:\s+\d+\s+R)?\s*>>\s*stream\r?\n(.*?)endstream",
+    re.DOTALL,
+)
+# Literal string operands of the text-showing operators: (...) Tj, ' and ",
+# and TJ arrays holding exactly one string. Several strings in one TJ are
+# kerned fragments of a run, e.g. [(IV1234-AGR12)-20(34)]TJ, and any one of
+# them may be a partial ID.
+_RE_BYTES_SHOW = re.compile(
+    rb"\(((?:[^()\\]|\\.)*)\)\s*(?:Tj|'|\")"
+    rb"|\[\s*(?:-?[\d.]+(?![\d.])\s*)*\(((?:[^()\\]|\\.)*)\)\s*(?:-?[\d.]+(?![\d.])\s*)*\]\s*TJ",
+    re.DOTALL,
+)
+_RE_BYTES_ESCAPE = re.compile(rb"\\([0-7]{1,3}|.)", re.DOTALL)
+_BYTES_ESCAPES = {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"\b", b"f": b"\f", b"\n": b""}
+_RE_BYTES_AGR = re.compile(rb"AGR\d{4,}", re.IGNORECASE)
+# Same order as _find_pair; the en dash is 0x96 in WinAnsi.
+_RE_BYTES_PAIRS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    rb"\b((?:IV|IN|CN)\d{5,})\s*[-\x96]\s*(AGR\d{4,})\b",
+    rb"\b(AGR\d{4,})\s*[-\x96]\s*((?:IV|IN|CN)\d{5,})\b",
+))
+
+_CORONA_INV_PATTERNS = tuple(_compile_ci(p) for p in (
+    r"\bCN\d+\b",
+    r"\bIN\d+\b",
+    r"Invoice\s+Number\s+(IV\d+|CN\d+)",
+))
+# Whitespace runs and the free-form ID are bounded so a pathological line
+# can't make the backtracking engines blow up. The trailing group rejects an
+# over-long ID instead of cutting it at 32 characters (re2 has no lookahead).
+_INV_LABEL_PATTERNS = tuple(_compile_ci(p) for p in (
+    r"\b(?:Invoice|Credit\s*Note)\s{0,64}(?:Number|No\.?|#)\s{0,64}:\s{0,64}((?:IV|IN|CN)\d{3,})",
+    r"\b(?:Invoice|Credit\s*Note)\s{0,64}(?:Number|No\.?|#)\s{0,64}([A-Z0-9-]{5,32})(?:[^A-Z0-9-]|$)",
+))
+# Highest priority first. Every keyword must appear in the lowercased text
+# (plain substring checks, far cheaper than a regex scan); only then is the
+# whitespace-tolerant name pattern, if any, run to confirm.
+_SUPPLIERS = (
+    ("CoronaEnergy", ("corona", "energy"), _compile_ci(r"corona\s+energy")),
+    ("PozitiveEnergy", ("pozitive",), None),
+    ("OctopusEnergy", ("octopus", "energy"), _compile_ci(r"octopus\s+energy")),
+    ("OVOEnergy", ("ovo",), _compile_ci(r"ovo\s+(?:energy|electricity)")),
+    ("SSE", ("sse", "energy"), None),
+)
+_SUPPLIER_RANK = {name: rank for rank, (name, _, _) in enumerate(_SUPPLIERS)}
+_AGR_LABEL_PATTERNS = tuple(_compile_ci(p) for p in (
+    r"Site\s*reference\s*ID\s*(AGR\d{4,})",
+    r"\bSite\s*ID\s*(AGR\d{4,})",
+))
+
+# -------------------------------
+# Extraction helpers
+# -------------------------------
 
 def _safe_filename(name: str) -> str:
-    name = re.sub(r'[\\/:*?"<>|]+', "_", name).strip().strip(".")
+    name = name.translate(_UNSAFE_TABLE).strip().strip(".")
     return name or "unnamed"
 
 def _detect_supplier(text: str) -> Optional[str]:
-    t = text.lower()
-    if "corona energy" in t:
-        return "CoronaEnergy"
-    if "pozitive" in t:
-        return "PozitiveEnergy"
-    if "octopus energy" in t:
-        return "OctopusEnergy"
-    if "ovo energy" in t or "ovo electricity" in t:
-        return "OVOEnergy"
-    if "sse" in t and "energy" in t:
-        return "SSE"
+    folded = text.lower()
+    for supplier, keywords, pattern in _SUPPLIERS:
+        if all(k in folded for k in keywords) and (pattern is None or pattern.search(text)):
+            return supplier
     return None
 
-# --- extract both AGR and invoice IDs ---
-def extract_ids_from_text(text: str) -> Tuple[Optional[str], Optional[str]]:
+def _find_pair(text: str) -> Tuple[Optional[str], Optional[str]]:
     # Hyphenated in either order
-    m = re.search(r"\b((?:IV|IN|CN)\d{5,})\s*[-–]\s*(AGR\d{4,})\b", text, re.IGNORECASE)
+    m = _RE_PAIR_INV_AGR.search(text)
     if m:
-        inv, agr = m.group(1).upper(), m.group(2).upper()
-        return inv, agr
-    m = re.search(r"\b(AGR\d{4,})\s*[-–]\s*((?:IV|IN|CN)\d{5,})\b", text, re.IGNORECASE)
+        return m.group(1).upper(), m.group(2).upper()
+    m = _RE_PAIR_AGR_INV.search(text)
     if m:
-        agr, inv = m.group(1).upper(), m.group(2).upper()
+        return m.group(2).upper(), m.group(1).upper()
+    return None, None
+
+def _scan_ids(pattern, text: str, want_agr: bool = True) -> Tuple[Optional[str], Optional[str]]:
+    inv = agr = None
+    for m in pattern.finditer(text):
+        kind = m.lastgroup
+        if kind == "inv":
+            inv = inv or m.group(kind).upper()
+        else:
+            agr = agr or m.group(kind).upper()
+        if inv and (agr or not want_agr):
+            break
+    return inv, agr
+
+def _corona_invoice(text: str) -> Optional[str]:
+    # CN anywhere beats IN anywhere beats the label, whatever the text order
+    for pat in _CORONA_INV_PATTERNS:
+        m = pat.search(text)
+        if m:
+            return (m.group(1) if m.groups() else m.group(0)).upper()
+    return None
+
+def _extract_corona(text: str) -> Tuple[Optional[str], Optional[str]]:
+    m = _RE_AGR.search(text)
+    return _corona_invoice(text), (m.group(0).upper() if m else None)
+
+def _extract_sse(text: str) -> Tuple[Optional[str], Optional[str]]:
+    # Supplier detection only needs "sse" and "energy" anywhere, which
+    # "Essex" or "processed" satisfy; only use the SSE layout when SSE
+    # actually appears as a word.
+    if not _RE_SSE_WORD.search(text):
+        return None, None
+    return _scan_ids(_RE_SSE_IDS, text)
+
+_VENDOR_EXTRACTORS = {
+    "CoronaEnergy": _extract_corona,
+    "SSE": _extract_sse,
+}
+
+# --- extract both AGR and invoice IDs ---
+def extract_ids_from_text(text: str, supplier: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+    inv, agr, _ = _find_ids(text.translate(_SPACE_TABLE), supplier)
+    return inv, agr
+
+def _find_ids(text: str, supplier: Optional[str]) -> Tuple[Optional[str], Optional[str], bool]:
+    # The flag says whether both IDs came from one hyphenated pair. A pair
+    # anywhere settles both, so it is looked for in the full text before the
+    # head window below can settle for bare matches.
+    inv, agr = _find_pair(text)
+    if inv:
+        return inv, agr, True
+    if len(text) > ID_SCAN_WINDOW:
+        inv, agr = _extract_ids(text[:ID_SCAN_WINDOW], supplier)
+        if inv and agr:
+            return inv, agr, False
+    inv, agr = _extract_ids(text, supplier)
+    return inv, agr, False
+
+def _extract_ids(text: str, supplier: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    # Substring probes on one lowercased copy are far cheaper than a regex
+    # scan and rule out pattern groups that cannot match.
+    folded = text.lower()
+    has_agr = "agr" in folded
+    is_corona = supplier == "CoronaEnergy" or (
+        "corona" in folded and _RE_CORONA.search(text) is not None)
+    if supplier is None and is_corona:
+        supplier = "CoronaEnergy"
+
+    # A known supplier's own pattern usually settles both IDs in one scan;
+    # anything it misses falls through to the generic cascade below.
+    vendor_extract = _VENDOR_EXTRACTORS.get(supplier)
+    if vendor_extract:
+        inv, agr = vendor_extract(text)
+        if inv and agr:
+            return inv, agr
+
+    inv, agr = _scan_ids(_RE_IDS if has_agr else _RE_INV, text, want_agr=has_agr)
+    if inv and agr:
         return inv, agr
 
     # Vendor-specific (Corona) for invoice
-    inv = None
-    if re.search(r"\bcorona\s+energy\b", text, re.IGNORECASE):
-        for pat in [r"\bCN\d+\b", r"\bIN\d+\b", r"Invoice Number\s+(IV\d+|CN\d+)"]:
-            m = re.search(pat, text, re.IGNORECASE)
+    if is_corona:
+        inv = _corona_invoice(text) or inv
+
+    # Labelled invoice fallbacks
+    if not inv and ("invoice" in folded or "credit" in folded):
+        for pat in _INV_LABEL_PATTERNS:
+            m = pat.search(text)
             if m:
-                inv = (m.group(1) if m.groups() else m.group(0)).upper()
+                inv = _RE_DASH.sub("-", m.group(1)).upper()
                 break
 
-    # Generic invoice fallbacks
-    if not inv:
-        for pat in [
-            r"\b(?:IV|IN|CN)\d{5,}\b",
-            r"\b(?:Invoice|Credit\s*Note)\s*(?:Number|No\.?|#)\s*:\s*((?:IV|IN|CN)\d{3,})",
-            r"\b(?:Invoice|Credit\s*Note)\s*(?:Number|No\.?|#)\s*([A-Z0-9\-]{5,})",
-        ]:
-            m = re.search(pat, text, re.IGNORECASE)
+    # Labelled AGR fallbacks
+    if not agr and has_agr:
+        for pat in _AGR_LABEL_PATTERNS:
+            m = pat.search(text)
             if m:
-                inv = (m.group(1) if m.groups() else m.group(0))
-                inv = re.sub(r"\s*[-–]\s*", "-", inv).upper()
+                agr = m.group(1).upper()
                 break
 
-    # AGR detection
-    agr = None
-    for pat in [r"\bAGR\d{4,}\b", r"Site\s*reference\s*ID\s*(AGR\d{4,})", r"\bSite\s*ID\s*(AGR\d{4,})"]:
-        m = re.search(pat, text, re.IGNORECASE)
-        if m:
-            agr = (m.group(1) if m.groups() else m.group(0)).upper()
-            break
-
     return inv, agr
 
-def extract_refs(data: bytes) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
-    try:
+def _unescape_literal(m) -> bytes:
+    c = m.group(1)
+    if c[:1].isdigit():
+        return bytes((int(c, 8) & 0xFF,))
+    return _BYTES_ESCAPES.get(c, c)
+
+def _scan_raw_bytes(data: bytes) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    # A hyphenated pair settles both IDs outright (it outranks every other
+    # match in the text cascade too), so it is the only hit trusted here.
+    # Pair and supplier both come from the shown strings alone, which are
+    # only pulled out once some content stream has an AGR number at all.
+    bodies = [m.group(1) for m in _RE_BYTES_CONTENT.finditer(data)]
+    if not any(_RE_BYTES_AGR.search(body) for body in bodies):
+        return None, None, None
+    shown = []
+    for body in bodies:
+        for m in _RE_BYTES_SHOW.finditer(body):
+            op = m.group(1) or m.group(2)
+            shown.append(_RE_BYTES_ESCAPE.sub(_unescape_literal, op) if b"\\" in op else op)
+    # NUL separators keep a pair from spanning two operands
+    joined = b"\0".join(shown)
+    for i, pat in enumerate(_RE_BYTES_PAIRS):
+        m = pat.search(joined)
+        if m:
+            inv, agr = (m.group(1), m.group(2)) if i == 0 else (m.group(2), m.group(1))
+            supplier = _detect_supplier(b"\n".join(shown).decode("latin-1").translate(_SPACE_TABLE))
+            return inv.decode("ascii").upper(), agr.decode("ascii").upper(), supplier
+    return None, None, None
+
+def _iter_page_texts(data: bytes) -> Iterator[str]:
+    # PDF libraries are imported on first use (then cached in sys.modules);
+    # each costs ~150 ms, which would otherwise delay the first page load.
+    if USE_PDFPLUMBER:
+        import pdfplumber
         with pdfplumber.open(BytesIO(data)) as pdf:
-            texts = []
             for page in pdf.pages:
                 t = page.extract_text() or ""
-                if t:
-                    texts.append(t)
-            text = _normalise_text("\n".join(texts))
-            if not text:
+                page.close()  # drops pdfplumber's per-page object cache
+                yield t
+        return
+    from pypdf import PdfReader
+    with PdfReader(BytesIO(data)) as reader:
+        for page in reader.pages:
+            yield page.extract_text() or ""
+
+def extract_refs(data: bytes) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    # Cheap pass over the raw bytes first; only parse the PDF if it misses,
+    # or if the supplier name isn't visible there (compressed streams).
+    inv, agr, supplier = _scan_raw_bytes(data)
+    if inv and agr and supplier:
+        return inv, agr, supplier, None
+
+    try:
+        with closing(_iter_page_texts(data)) as pages:
+            # IDs almost always sit on page 1, so parse pages lazily and stop
+            # as soon as both are found (or page 2 still has no AGR). Each
+            # page is scanned once, with a little overlap. Earlier pages' bare
+            # hits win, but a pair on a later page replaces them both, so
+            # the two IDs never come from different places.
+            has_text = False
+            tail = ""
+            inv = agr = supplier = None
+            for page_no, t in enumerate(pages, start=1):
+                if not t or t.isspace():
+                    continue
+                has_text = True
+                t = t.translate(_SPACE_TABLE)
+                chunk = f"{tail}\n{t}" if tail else t
+                tail = t[-PAGE_OVERLAP:]
+
+                found = _detect_supplier(chunk)
+                if found and (supplier is None or _SUPPLIER_RANK[found] < _SUPPLIER_RANK[supplier]):
+                    supplier = found
+                page_inv, page_agr, paired = _find_ids(chunk, supplier)
+                if paired:
+                    inv, agr = page_inv, page_agr
+                    break
+                inv = inv or page_inv
+                agr = agr or page_agr
+                if inv and (agr or page_no >= 2):
+                    break
+            if not has_text:
                 return None, None, None, "No extractable text (scanned image PDF?)"
 
-            supplier = _detect_supplier(text)
-            inv, agr = extract_ids_from_text(text)
             return (inv.upper() if inv else None,
                     agr.upper() if agr else None,
                     supplier,
@@ -96,6 +345,15 @@ def extract_refs(data: bytes) -> Tuple[Optional[str], Optional[str], Optional[st
     except Exception as e:
         return None, None, None, f"Read error: {e}"
 
+def _content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def extract_refs_cached(data_hash: str, _data: bytes) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    # Keyed on data_hash only; the leading underscore stops Streamlit hashing
+    # the PDF bytes again. Re-uploads of the same file skip parsing entirely.
+    return extract_refs(_data)
+
 # -------------------------------
 # Renaming / zipping
 # -------------------------------
@@ -115,13 +373,17 @@ def rename_and_zip_files(uploaded_files, prefix: str = "") -> Tuple[BytesIO, lis
     results = []
     seen = set()
 
-    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as z:
-        for f in uploaded_files:
-            f.seek(0)
-            data = f.read()
-
-            inv, agr, supplier, err = extract_refs(data)
+    # Each upload is read once; the same bytes feed the extractor and the
+    # zip, and are dropped as soon as they are stored.
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as z:
+        for i, f in enumerate(uploaded_files, start=1):
+            data = f.getvalue()
+            inv, agr, supplier, err = extract_refs_cached(_content_hash(data), data)
             note = err or ""
+            # Parser objects can hang on through reference cycles; collect
+            # them periodically so memory stays flat over long batches.
+            if i % 20 == 0:
+                gc.collect()
 
             if inv and agr:
                 out_base = f"{prefix}{inv}-{agr}"       # <-- INV first, then AGR
@@ -133,6 +395,7 @@ def rename_and_zip_files(uploaded_files, prefix: str = "") -> Tuple[BytesIO, lis
 
             out_name = ensure_unique(_safe_filename(out_base) + ".pdf", seen)
             z.writestr(out_name, data)
+            del data
 
             results.append({
                 "original_name": f.name,
@@ -178,10 +441,9 @@ if uploaded_files and st.button("Process and Download"):
     with st.spinner("Processing…"):
         if len(uploaded_files) == 1:
             f = uploaded_files[0]
-            f.seek(0)
-            data = f.read()
+            data = f.getvalue()
 
-            inv, agr, supplier, err = extract_refs(data)
+            inv, agr, supplier, err = extract_refs_cached(_content_hash(data), data)
             if inv and agr:
                 base = f"{prefix}{inv}-{agr}"          # <-- INV first, then AGR
             elif inv: